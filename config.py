@@ -19,8 +19,14 @@ class Config:
     BASE_DATA_PATH = "C:\\Users\\wangze\\OneDrive - IAEA\\Desktop\\Nuclear power excel\\clean data"
     
     # ===== Processing Parameters =====
-    BATCH_SIZE = 30  # GPT batch processing size
-    API_DELAY = 1.0  # API call delay in seconds
+    BATCH_SIZE = 100  # Maximum posts per GPT request
+    MAX_INPUT_TOKENS = 6000  # Input token budget per GPT request
+    TOKEN_SAFETY_MARGIN = 200  # Tokens reserved for user instructions
+    API_DELAY = 1.0  # Base delay in seconds for rate-limit backoff
+    MAX_CONCURRENT_REQUESTS = 8  # Maximum in-flight GPT requests
+    MAX_RETRIES = 5  # Retries per batch when rate limited
+    INTERMEDIATE_FORMAT = "parquet"  # Quarterly file format: "parquet" or "xlsx"
+    ENABLE_CACHE = True  # Reuse cached sentiments for previously classified texts
     
     # ===== Analysis Topic Configuration =====
     # TODO: Change this to your analysis topic (e.g., "climate change", "cryptocurrency", "AI technology")
@@ -56,10 +62,20 @@ class Config:
         """Get output file path"""
         return f"{cls.BASE_DATA_PATH}\\results_{year}_sentiment.xlsx"
     
+    @classmethod
+    def get_combined_results_path(cls) -> str:
+        """Get combined sentiment results path (all years, labelled by quarter)"""
+        return f"{cls.BASE_DATA_PATH}\\all_sentiments.parquet"
+    
+    @classmethod
+    def get_cache_file_path(cls) -> str:
+        """Get sentiment cache database path"""
+        return f"{cls.BASE_DATA_PATH}\\sentiment_cache.sqlite"
+    
     @classmethod
     def get_quarterly_file_path(cls, year: int, quarter: str) -> str:
         """Get quarterly file path"""
-        return f"{cls.BASE_DATA_PATH}\\{year}_{quarter}.xlsx"
+        return f"{cls.BASE_DATA_PATH}\\{year}_{quarter}.{cls.INTERMEDIATE_FORMAT}"
     
     @classmethod
     def get_chart_output_path(cls, year_range: tuple) -> str:
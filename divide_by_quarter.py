@@ -2,12 +2,13 @@
 Step 2: Quarterly Data Segmentation Module
 Functionality: Split timestamped data into separate quarterly files
 Input: Excel files with timestamp columns
-Output: Files named by year_quarter (e.g., 2024_Q1.xlsx)
+Output: Files named by year_quarter (e.g., 2024_Q1.parquet)
 """
 import os
 import pandas as pd
+from collections import defaultdict
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from config import Config
 
 
@@ -17,89 +18,57 @@ class QuarterlyDataProcessor:
     def __init__(self, source_folder: str = None):
         """Initialize processor with data folder"""
         self.source_folder = source_folder or Config.BASE_DATA_PATH
+        # Quarterly slices awaiting a single concat + write, keyed by (year, quarter)
+        self._pending: Dict[Tuple[str, str], List[pd.DataFrame]] = defaultdict(list)
         
-    def get_quarter(self, month: int) -> str:
-        """Get quarter based on month number"""
-        if 1 <= month <= 3:
-            return "Q1"
-        elif 4 <= month <= 6:
-            return "Q2"
-        elif 7 <= month <= 9:
-            return "Q3"
-        else:
-            return "Q4"
-    
-    def process_single_file(self, file_path: str) -> None:
-        """Process a single file and split data by quarters"""
+    def process_single_file(self, file_path: str) -> bool:
+        """Process a single file and queue its data split by quarters"""
         print(f"=== Processing file: {file_path} ===")
         
         try:
-            # Read data
-            df = pd.read_excel(file_path)
-            
-            # Use UTC_Time column
-            if "UTC_Time" not in df.columns:
-                raise ValueError("No UTC_Time column found in file")
-            
             timestamp_column = "UTC_Time"
             
-            # Ensure timestamp is datetime type
-            df[timestamp_column] = pd.to_datetime(df[timestamp_column], errors='coerce')
+            # Read data, parsing timestamps and typing text columns at read time
+            df = pd.read_excel(file_path, engine="calamine", parse_dates=[timestamp_column],
+                               dtype={"text": "string", "sentiment": "category"})
+            
+            # Coerce only if some timestamps could not be parsed on read;
+            # mixed formats and offsets are parsed per value and normalized to UTC
+            if not pd.api.types.is_datetime64_any_dtype(df[timestamp_column]):
+                df[timestamp_column] = pd.to_datetime(df[timestamp_column], errors='coerce',
+                                                      utc=True, format='mixed')
             # Remove timezone info
             df[timestamp_column] = df[timestamp_column].dt.tz_localize(None)
             
+            # Drop rows without a valid timestamp
+            valid_mask = df[timestamp_column].notna()
+            skipped_count = int((~valid_mask).sum())
+            df = df.loc[valid_mask].reset_index(drop=True)
+            processed_count = len(df)
+            
             # Extract year from filename or data
             filename = os.path.basename(file_path)
             try:
                 year = filename.split("_")[-1].split(".")[0]
                 if not year.isdigit():
                     # Try to extract year from data
-                    valid_dates = df[timestamp_column].dropna()
-                    if len(valid_dates) > 0:
-                        year = str(valid_dates.dt.year.mode()[0])
+                    if processed_count > 0:
+                        year = str(df[timestamp_column].dt.year.mode()[0])
                     else:
                         year = "unknown"
             except:
                 year = "unknown"
             
-            # Create quarterly data dictionary
-            quarterly_data = {"Q1": [], "Q2": [], "Q3": [], "Q4": []}
-            processed_count = 0
-            skipped_count = 0
-            
-            # Process data row by row
-            for _, row in df.iterrows():
-                if pd.notna(row[timestamp_column]):
-                    quarter = self.get_quarter(row[timestamp_column].month)
-                    quarterly_data[quarter].append(row)
-                    processed_count += 1
-                else:
-                    skipped_count += 1
+            # Split data by quarter in a single vectorized pass
+            for quarter, quarter_df in df.groupby(df[timestamp_column].dt.quarter, sort=True):
+                self._pending[(year, f"Q{quarter}")].append(quarter_df)
             
-            print(f"Processed {processed_count} records, skipped {skipped_count} invalid timestamp records")
-            
-            # Save quarterly files
-            saved_files = []
-            for quarter, rows in quarterly_data.items():
-                if rows:  # Only create file if data exists
-                    quarter_file_path = Config.get_quarterly_file_path(year, quarter)
-                    
-                    # Merge with existing file if exists
-                    if os.path.exists(quarter_file_path):
-                        existing_df = pd.read_excel(quarter_file_path)
-                        new_df = pd.concat([existing_df, pd.DataFrame(rows)], ignore_index=True)
-                        print(f"Merged with existing file: {quarter_file_path}")
-                    else:
-                        new_df = pd.DataFrame(rows)
-                        print(f"Created new file: {quarter_file_path}")
-                    
-                    new_df.to_excel(quarter_file_path, index=False)
-                    saved_files.append(f"{year}_{quarter}.xlsx ({len(rows)} records)")
-            
-            print(f"✅ Successfully generated quarterly files: {', '.join(saved_files)}\n")
+            print(f"Processed {processed_count} records, skipped {skipped_count} invalid timestamp records\n")
+            return True
             
         except Exception as e:
             print(f"❌ Failed to process file: {e}\n")
+            return False
     
     def process_all_files(self) -> None:
         """Process all qualifying files in the folder"""
@@ -127,10 +96,29 @@ class QuarterlyDataProcessor:
         print()
         
         # Process each file
+        self._pending.clear()
         for file in files:
             file_path = os.path.join(self.source_folder, file)
             self.process_single_file(file_path)
         
+        if not self._pending:
+            print("❌ No valid data found in any file")
+            return
+        
+        # Concatenate each (year, quarter) partition once and write it exactly once
+        saved_files = []
+        for (year, quarter), frames in sorted(self._pending.items()):
+            quarter_file_path = Config.get_quarterly_file_path(year, quarter)
+            quarter_df = pd.concat(frames, ignore_index=True)
+            if Config.INTERMEDIATE_FORMAT == "parquet":
+                quarter_df.to_parquet(quarter_file_path, index=False, compression="snappy")
+            else:
+                quarter_df.to_excel(quarter_file_path, index=False)
+            saved_files.append(f"{os.path.basename(quarter_file_path)} ({len(quarter_df)} records)")
+        
+        self._pending.clear()
+        
+        print(f"✅ Successfully generated quarterly files: {', '.join(saved_files)}\n")
         print("🎉 All files processed successfully!")
 
 
@@ -1,19 +1,21 @@
 """
 Step 3: Sentiment Trend Visualization Module
 Functionality: Read quarterly data, calculate sentiment percentages and generate trend charts
-Input: Quarterly Excel files with sentiment columns
+Input: Combined results Parquet file from Step 1, or quarterly files with sentiment columns
 Output: Sentiment trend line chart PNG file
 """
+import os
 import pandas as pd 
 import matplotlib.pyplot as plt
-import os
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Set, Tuple, Optional
 from config import Config
 
 
 class SentimentVisualizer:
     """Visualizer for sentiment trends analysis"""
     
+    SENTIMENT_DTYPE = pd.CategoricalDtype(categories=['Positive', 'Negative', 'Neutral'])
+    
     def __init__(self, data_folder: str = None):
         """Initialize visualizer with data folder"""
         self.data_folder = data_folder or Config.BASE_DATA_PATH
@@ -29,62 +31,151 @@ class SentimentVisualizer:
             return 'sentiment'
         return None
     
-    def process_quarterly_file(self, file_path: str, quarter_name: str) -> bool:
-        """Process a single quarterly file"""
+    def normalize_sentiments(self, sentiments: pd.Series) -> pd.Series:
+        """Normalize label casing/whitespace once into compact categorical codes"""
+        sentiments = sentiments.astype("string").str.strip().str.capitalize()
+        # Labels outside the known categories become NA (still counted in each quarter's total)
+        return sentiments.where(sentiments.isin(self.SENTIMENT_DTYPE.categories)).astype(self.SENTIMENT_DTYPE)
+    
+    def process_quarterly_file(self, file_path: str, quarter_name: str) -> Optional[pd.DataFrame]:
+        """Read the sentiment labels of a single quarterly file, tagged with its quarter"""
         try:
             print(f"Processing file: {quarter_name}")
-            df = pd.read_excel(file_path, engine='openpyxl')
+            if Config.INTERMEDIATE_FORMAT == "parquet":
+                df = pd.read_parquet(file_path, columns=['sentiment'])
+            else:
+                df = pd.read_excel(file_path, engine='calamine',
+                                   usecols=lambda col: col == 'sentiment', dtype={'sentiment': 'category'})
             
             # Auto-detect sentiment column
             sentiment_col = self.find_sentiment_column(df)
             if sentiment_col is None:
                 print(f"⚠️ Skipping {quarter_name}: No sentiment column found")
-                return False
-            
-            # Calculate percentage for each sentiment category
-            sentiment_counts = df[sentiment_col].value_counts(normalize=True) * 100
-            print(f"  Sentiment distribution: {dict(sentiment_counts)}")
-            
-            # Ensure all sentiment categories have values, fill with 0 if missing
-            positive = (sentiment_counts.get("Positive", 0) + 
-                       sentiment_counts.get("positive", 0))
-            negative = (sentiment_counts.get("Negative", 0) + 
-                       sentiment_counts.get("negative", 0))
-            neutral = (sentiment_counts.get("Neutral", 0) + 
-                      sentiment_counts.get("neutral", 0))
-            
-            # Add to dataset
-            self.sentiment_data["quarter"].append(quarter_name)
-            self.sentiment_data["positive"].append(positive)
-            self.sentiment_data["negative"].append(negative)
-            self.sentiment_data["neutral"].append(neutral)
+                return None
             
-            print(f"  ✅ Successfully processed: P={positive:.1f}%, N={negative:.1f}%, Neu={neutral:.1f}%")
-            return True
+            sentiments = self.normalize_sentiments(df[sentiment_col])
+            return pd.DataFrame({'sentiment': sentiments, 'quarter': quarter_name})
             
         except Exception as e:
             print(f"❌ Failed to process {quarter_name}: {e}")
+            return None
+    
+    def find_existing_files(self, file_paths: List[str]) -> Set[str]:
+        """Return the paths that exist, using one directory scan per folder"""
+        # Group and match on normalized names so non-canonical folder paths still match
+        paths_by_folder: Dict[str, List[str]] = {}
+        for path in file_paths:
+            paths_by_folder.setdefault(os.path.normcase(os.path.dirname(path)), []).append(path)
+        
+        existing = set()
+        for folder, paths in paths_by_folder.items():
+            try:
+                with os.scandir(folder or ".") as entries:
+                    names = {os.path.normcase(entry.name) for entry in entries if entry.is_file()}
+            except OSError:
+                continue
+            existing.update(path for path in paths if os.path.normcase(os.path.basename(path)) in names)
+        return existing
+    
+    def get_quarterly_paths(self, year_range: Tuple[int, int]) -> Dict[Tuple[int, str], str]:
+        """Map each (year, quarter) in the year range to its quarterly file path"""
+        return {(year, quarter): Config.get_quarterly_file_path(year, quarter)
+                for year in range(year_range[0], year_range[1] + 1)
+                for quarter in ["Q1", "Q2", "Q3", "Q4"]}
+    
+    def combined_is_newer(self, combined_path: str, year_range: Tuple[int, int]) -> bool:
+        """Check whether the combined results are newer than every existing quarterly file"""
+        if not os.path.exists(combined_path):
             return False
+        existing_files = self.find_existing_files(list(self.get_quarterly_paths(year_range).values()))
+        newest_quarterly = max((os.path.getmtime(path) for path in existing_files), default=None)
+        return newest_quarterly is None or os.path.getmtime(combined_path) >= newest_quarterly
     
-    def collect_data(self, year_range: Tuple[int, int]) -> None:
-        """Collect quarterly data for specified year range"""
+    def load_combined_results(self, file_path: str, year_range: Tuple[int, int]) -> Tuple[Optional[pd.DataFrame], List[str]]:
+        """Read quarter-labelled sentiments for the year range from the combined results file"""
+        print(f"Reading combined results: {file_path}")
+        try:
+            df = pd.read_parquet(file_path, columns=['year', 'quarter', 'sentiment'],
+                                 filters=[('year', '>=', year_range[0]), ('year', '<=', year_range[1])])
+        except Exception as e:
+            print(f"❌ Failed to read combined results: {e}")
+            return None, []
+        
+        # Rows without a valid timestamp have no quarter and are left out
+        skipped_count = int(df['quarter'].isna().sum())
+        if skipped_count:
+            print(f"⚠️ Skipped {skipped_count} invalid timestamp records")
+        df = df.dropna(subset=['quarter'])
+        all_df = pd.DataFrame({
+            'sentiment': self.normalize_sentiments(df['sentiment']),
+            'quarter': df['year'].astype(str) + '_' + df['quarter'].astype(str)
+        })
+        return all_df, sorted(all_df['quarter'].unique())
+    
+    def load_quarterly_files(self, year_range: Tuple[int, int]) -> Tuple[Optional[pd.DataFrame], List[str]]:
+        """Read sentiment labels from the per-quarter files for the year range"""
+        # Build all quarterly paths once and check them with a single directory scan
+        paths = self.get_quarterly_paths(year_range)
+        existing_files = self.find_existing_files(list(paths.values()))
+        
+        frames = []
+        quarter_names = []
+        for (year, quarter), file_path in paths.items():
+            quarter_name = f"{year}_{quarter}"
+            
+            if file_path in existing_files:
+                quarter_df = self.process_quarterly_file(file_path, quarter_name)
+                if quarter_df is not None:
+                    frames.append(quarter_df)
+                    quarter_names.append(quarter_name)
+            else:
+                print(f"⚠️ File does not exist: {quarter_name}")
+        
+        all_df = pd.concat(frames, ignore_index=True) if frames else None
+        return all_df, quarter_names
+    
+    def collect_data(self, year_range: Tuple[int, int], use_combined: Optional[bool] = None) -> None:
+        """Collect quarterly data for specified year range
+        
+        use_combined selects the combined results of Step 1 (True) or the quarterly
+        files of Step 2 (False); by default whichever was written more recently is used.
+        """
         print(f"=== Starting to collect quarterly data for {year_range[0]}-{year_range[1]} ===")
         
-        processed_count = 0
-        for year in range(year_range[0], year_range[1] + 1):
-            for quarter in ["Q1", "Q2", "Q3", "Q4"]:
-                file_path = Config.get_quarterly_file_path(year, quarter)
-                quarter_name = f"{year}_{quarter}"
-                
-                if os.path.exists(file_path):
-                    if self.process_quarterly_file(file_path, quarter_name):
-                        processed_count += 1
-                else:
-                    print(f"⚠️ File does not exist: {quarter_name}")
-        
-        print(f"\n✅ Successfully processed {processed_count} quarterly files")
-    
-    def generate_chart(self, output_path: str, title: str = None) -> None:
+        combined_path = Config.get_combined_results_path()
+        if use_combined is None:
+            use_combined = self.combined_is_newer(combined_path, year_range)
+        
+        all_df, quarter_names = None, []
+        if use_combined:
+            if os.path.exists(combined_path):
+                all_df, quarter_names = self.load_combined_results(combined_path, year_range)
+            else:
+                print(f"⚠️ Combined results not found: {combined_path}")
+        
+        # Quarterly files are used when selected or when combined results are unavailable
+        if all_df is None:
+            all_df, quarter_names = self.load_quarterly_files(year_range)
+        
+        if quarter_names:
+            # Aggregate all quarters in a single pass over the categorical codes
+            percentages = (all_df.groupby('quarter', sort=False)['sentiment']
+                           .value_counts(normalize=True, dropna=False)
+                           .mul(100)
+                           .unstack(fill_value=0.0)
+                           .reindex(index=quarter_names, columns=self.SENTIMENT_DTYPE.categories, fill_value=0.0))
+            
+            for quarter_name, row in percentages.iterrows():
+                print(f"  ✅ {quarter_name}: P={row['Positive']:.1f}%, N={row['Negative']:.1f}%, Neu={row['Neutral']:.1f}%")
+            
+            self.sentiment_data["quarter"].extend(percentages.index)
+            self.sentiment_data["positive"].extend(percentages['Positive'])
+            self.sentiment_data["negative"].extend(percentages['Negative'])
+            self.sentiment_data["neutral"].extend(percentages['Neutral'])
+        
+        print(f"\n✅ Successfully processed {len(quarter_names)} quarters")
+    
+    def generate_chart(self, output_path: str, title: str = None, show: bool = False) -> None:
         """Generate sentiment trend line chart"""
         if not self.sentiment_data["quarter"]:
             print("❌ No data available for plotting")
@@ -98,48 +189,50 @@ class SentimentVisualizer:
         
         # Create chart
         chart_config = Config.CHART_CONFIG
-        plt.figure(figsize=chart_config['figsize'])
+        fig, ax = plt.subplots(figsize=chart_config['figsize'])
         
         # Draw three trend lines using configuration
         colors = chart_config['colors']
         markers = chart_config['markers']
         
-        plt.plot(result_df['quarter'], result_df['positive'], 
+        ax.plot(result_df['quarter'], result_df['positive'], 
                 marker=markers['positive'], label='Positive', color=colors['positive'], 
                 linewidth=2, markersize=6)
-        plt.plot(result_df['quarter'], result_df['negative'], 
+        ax.plot(result_df['quarter'], result_df['negative'], 
                 marker=markers['negative'], label='Negative', color=colors['negative'], 
                 linewidth=2, markersize=6)
-        plt.plot(result_df['quarter'], result_df['neutral'], 
+        ax.plot(result_df['quarter'], result_df['neutral'], 
                 marker=markers['neutral'], label='Neutral', color=colors['neutral'], 
                 linewidth=2, markersize=6)
         
         # Set chart style
-        plt.xlabel("Time Quarter", fontsize=12)
-        plt.ylabel("Percentage (%)", fontsize=12)
+        ax.set_xlabel("Time Quarter", fontsize=12)
+        ax.set_ylabel("Percentage (%)", fontsize=12)
         
         # Set title
         if title is None:
             title = chart_config['title_template'].format(topic=Config.ANALYSIS_TOPIC.title())
-        plt.title(title, fontsize=14, fontweight='bold')
+        ax.set_title(title, fontsize=14, fontweight='bold')
         
         # Legend and grid
-        plt.legend(fontsize=11, loc='upper right')
-        plt.grid(True, alpha=0.3)
+        ax.legend(fontsize=11, loc='upper right')
+        ax.grid(True, alpha=0.3)
         
         # Rotate x-axis labels
-        plt.xticks(rotation=45, fontsize=10)
-        plt.yticks(fontsize=10)
+        ax.tick_params(axis='x', rotation=45, labelsize=10)
+        ax.tick_params(axis='y', labelsize=10)
         
         # Adjust layout
-        plt.tight_layout()
+        fig.tight_layout()
         
         # Save chart
-        plt.savefig(output_path, dpi=chart_config['dpi'], bbox_inches='tight')
+        fig.savefig(output_path, dpi=chart_config['dpi'], bbox_inches='tight')
         print(f"✅ Trend chart saved to: {output_path}")
         
-        # Display chart
-        plt.show()
+        # Display chart only when requested
+        if show:
+            plt.show()
+        plt.close(fig)
     
     def print_summary(self) -> None:
         """Print data summary"""
@@ -172,7 +265,7 @@ def main():
     # Generate chart
     output_path = Config.get_chart_output_path(year_range)
     chart_title = f"{Config.ANALYSIS_TOPIC.title()} Sentiment Trends ({year_range[0]}-{year_range[1]})"
-    visualizer.generate_chart(output_path, chart_title)
+    visualizer.generate_chart(output_path, chart_title, show=True)
     
     # Print summary
     visualizer.print_summary()
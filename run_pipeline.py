@@ -3,6 +3,12 @@ Social Media Sentiment Analysis Pipeline - Main Execution Script
 Execute three steps in sequence: Sentiment Analysis -> Quarterly Segmentation -> Trend Visualization
 """
 import sys
+import matplotlib
+from typing import Optional
+
+# Pipeline runs are headless: render charts off-screen without a GUI toolkit
+matplotlib.use("Agg")
+
 from config import Config
 from sentiment_gpt import SentimentAnalyzer
 from divide_by_quarter import QuarterlyDataProcessor
@@ -13,17 +19,15 @@ def run_sentiment_analysis():
     """Step 1: Run sentiment analysis"""
     print("🚀 Step 1: Starting sentiment analysis...")
     
-    analyzer = SentimentAnalyzer()
-    
-    for year in Config.ANALYSIS_YEARS:
-        input_file = Config.get_input_file_path(year)
-        output_file = Config.get_output_file_path(year)
-        
-        try:
-            analyzer.analyze_file(input_file, output_file)
-        except Exception as e:
-            print(f"❌ Sentiment analysis failed for year {year}: {e}")
-            return False
+    try:
+        analyzer = SentimentAnalyzer()
+        # All years are classified together and split back into per-year files.
+        # Requests already run concurrently via async batching, so per-year worker
+        # processes would add no throughput and would each overwrite the combined store.
+        analyzer.analyze_years(Config.ANALYSIS_YEARS)
+    except Exception as e:
+        print(f"❌ Sentiment analysis failed: {e}")
+        return False
     
     print("✅ Step 1 completed: Sentiment Analysis\n")
     return True
@@ -45,8 +49,8 @@ def run_quarterly_division():
     return True
 
 
-def run_visualization():
-    """Step 3: Run trend visualization"""
+def run_visualization(use_combined: Optional[bool] = None):
+    """Step 3: Run trend visualization (use_combined selects the Step 1 or Step 2 output)"""
     print("🚀 Step 3: Starting trend visualization...")
     
     visualizer = SentimentVisualizer()
@@ -59,12 +63,12 @@ def run_visualization():
             year_range = (2024, 2025)  # Default fallback
         
         # Collect data
-        visualizer.collect_data(year_range)
+        visualizer.collect_data(year_range, use_combined=use_combined)
         
         # Generate chart
         output_path = Config.get_chart_output_path(year_range)
         chart_title = f"{Config.ANALYSIS_TOPIC.title()} Sentiment Trends ({year_range[0]}-{year_range[1]})"
-        visualizer.generate_chart(output_path, chart_title)
+        visualizer.generate_chart(output_path, chart_title, show=False)
         
         # Print summary
         visualizer.print_summary()
@@ -94,7 +98,7 @@ def main():
     print("1. Sentiment Analysis Only")
     print("2. Quarterly Segmentation Only") 
     print("3. Trend Visualization Only")
-    print("4. Run Complete Pipeline (1->2->3)")
+    print("4. Run Complete Pipeline (1->3, quarterly files are not needed)")
     print("5. Skip Sentiment Analysis (2->3)")
     
     try:
@@ -112,14 +116,13 @@ def main():
     elif choice == "3":
         success = run_visualization()
     elif choice == "4":
-        # Complete pipeline
+        # Complete pipeline: Step 3 aggregates the combined results of Step 1 directly
         success = (run_sentiment_analysis() and 
-                  run_quarterly_division() and 
-                  run_visualization())
+                  run_visualization(use_combined=True))
     elif choice == "5":
-        # Skip sentiment analysis
+        # Skip sentiment analysis: Step 3 reads the quarterly files just written
         success = (run_quarterly_division() and 
-                  run_visualization())
+                  run_visualization(use_combined=False))
     else:
         print("❌ Invalid choice")
         sys.exit(1)
@@ -0,0 +1,52 @@
+"""
+Sentiment Cache Module
+Functionality: Persist sentiment labels keyed by text content hash
+Storage: SQLite database in the data folder, reused across pipeline runs
+"""
+import sqlite3
+from blake3 import blake3
+from typing import Iterable, List, Optional
+
+
+class SentimentCache:
+    """On-disk cache mapping text content hashes to sentiment labels"""
+    
+    LOOKUP_CHUNK_SIZE = 900  # Stay below SQLite's bound-parameter limit
+    
+    def __init__(self, db_path: str, namespace: str = ""):
+        """Open or create the cache database (namespace separates prompts/models)"""
+        self.db_path = db_path
+        self.key = blake3(namespace.encode("utf-8")).digest()
+        
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (h BLOB PRIMARY KEY, s TEXT) WITHOUT ROWID")
+        self.conn.commit()
+    
+    def hash_text(self, text: str) -> bytes:
+        """Get content hash for a text within this cache's namespace"""
+        return blake3(text.encode("utf-8"), key=self.key).digest()
+    
+    def get_many(self, texts: List[str]) -> List[Optional[str]]:
+        """Look up cached sentiments, returning None for each cache miss"""
+        hashes = [self.hash_text(text) for text in texts]
+        unique_hashes = list(dict.fromkeys(hashes))
+        
+        found = {}
+        for i in range(0, len(unique_hashes), self.LOOKUP_CHUNK_SIZE):
+            chunk = unique_hashes[i:i + self.LOOKUP_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(self.conn.execute(f"SELECT h, s FROM cache WHERE h IN ({placeholders})", chunk))
+        
+        return [found.get(h) for h in hashes]
+    
+    def put_many(self, texts: Iterable[str], sentiments: Iterable[str]) -> None:
+        """Store sentiments for texts, keeping any existing entries"""
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO cache VALUES (?, ?)",
+            zip((self.hash_text(text) for text in texts), sentiments)
+        )
+        self.conn.commit()
+    
+    def close(self) -> None:
+        """Close the database connection"""
+        self.conn.close()
@@ -1,21 +1,30 @@
 """
 Step 1: Sentiment Analysis Module
 Functionality: Analyze sentiment of social media posts using GPT
-Input: Excel file with text content column
-Output: Excel file with text and sentiment columns
+Input: Excel file with text content column (and optional UTC_Time column)
+Output: Excel file with text, sentiment and UTC_Time columns, plus a combined
+        Parquet file labelled by year and quarter
 """
 import os
 import pandas as pd
-import time
-import json
-from openai import AzureOpenAI
+import asyncio
+import tiktoken
+from openai import AsyncAzureOpenAI, RateLimitError
 from typing import List, Dict, Optional
 from config import Config
+from sentiment_cache import SentimentCache
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 class SentimentAnalyzer:
     """Social media sentiment analyzer using GPT models"""
     
+    VALID_SENTIMENTS = ("Positive", "Negative", "Neutral")
+    
     def __init__(self):
         """Initialize sentiment analyzer with configuration"""
         self.azure_endpoint = Config.AZURE_OPENAI_ENDPOINT
@@ -23,56 +32,153 @@ class SentimentAnalyzer:
         self.api_version = Config.AZURE_API_VERSION
         self.api_key = Config.AZURE_API_KEY
         
-        self.client = AzureOpenAI(
+        # Async client is created per run so it is bound to the active event loop
+        self.aclient: Optional[AsyncAzureOpenAI] = None
+        
+        self.batch_size = Config.BATCH_SIZE
+        self.api_delay = Config.API_DELAY
+        self.max_concurrent_requests = Config.MAX_CONCURRENT_REQUESTS
+        self.max_retries = Config.MAX_RETRIES
+        
+        # Static prompt parts, built once and reused for every batch
+        self._system_prompt = Config.get_sentiment_prompt()
+        self._user_prefix = "Classify the sentiment of these social media posts (Positive, Negative, or Neutral):\n"
+        
+        # Tokenizer for packing batches, loaded on first use since it may need a download
+        self.encoding = None
+        self.max_input_tokens = Config.MAX_INPUT_TOKENS
+        self.token_safety_margin = Config.TOKEN_SAFETY_MARGIN
+        self.prompt_tokens = 0
+        
+        # Content-hash cache, opened only for the duration of a run
+        self.cache: Optional[SentimentCache] = None
+    
+    def _create_client(self) -> AsyncAzureOpenAI:
+        """Create async Azure OpenAI client"""
+        return AsyncAzureOpenAI(
             azure_endpoint=self.azure_endpoint,
             api_key=self.api_key,
             api_version=self.api_version,
         )
-        
-        self.batch_size = Config.BATCH_SIZE
-        self.api_delay = Config.API_DELAY
     
-    def extract_text_from_excel(self, file_path: str) -> List[str]:
-        """Extract text content from Excel file (expects Tweet_Content column)"""
+    def _open_cache(self) -> None:
+        """Open the sentiment cache, continuing without it if unavailable"""
+        if not Config.ENABLE_CACHE or self.cache is not None:
+            return
+        try:
+            # Namespaced so a new model or topic never reuses old labels
+            self.cache = SentimentCache(
+                Config.get_cache_file_path(),
+                namespace=f"{self.deployment_name}\n{self._system_prompt}"
+            )
+        except Exception as e:
+            print(f"⚠️ Sentiment cache unavailable, continuing without it: {e}")
+            self.cache = None
+    
+    def _close_cache(self) -> None:
+        """Close the sentiment cache if open"""
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+    
+    def extract_posts_from_excel(self, file_path: str) -> pd.DataFrame:
+        """Extract text content and timestamps from Excel file (UTC_Time column is optional)"""
         print(f"Reading file: {file_path}")
-        df = pd.read_excel(file_path, usecols=["Tweet_Content"], dtype=str)
-        documents = df["Tweet_Content"].dropna().tolist()
-        print(f"Successfully extracted {len(documents)} text entries")
-        return documents
+        df = pd.read_excel(file_path, usecols=lambda col: col in ("Tweet_Content", "UTC_Time"),
+                           dtype={"Tweet_Content": "string"}, engine="calamine")
+        df = df.dropna(subset=["Tweet_Content"]).rename(columns={"Tweet_Content": "text"})
+        print(f"Successfully extracted {len(df)} text entries")
+        return df
+    
+    def _load_encoding(self) -> bool:
+        """Load the tokenizer for batch packing, returning False if it is unavailable"""
+        if self.encoding is not None:
+            return True
+        
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(self.deployment_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"⚠️ Tokenizer unavailable ({e}), using fixed batches of {self.batch_size}")
+            return False
+        
+        self.encoding = encoding
+        self.prompt_tokens = (len(encoding.encode(self._system_prompt)) +
+                              len(encoding.encode(self._user_prefix)))
+        return True
     
-    def classify_sentiment_batch(self, texts: List[str]) -> List[str]:
+    def pack_batches(self, documents: List[str]) -> List[List[str]]:
+        """Greedily pack documents into batches that fit the input token budget"""
+        if not self._load_encoding():
+            return [documents[i:i + self.batch_size] for i in range(0, len(documents), self.batch_size)]
+        
+        token_budget = self.max_input_tokens - self.prompt_tokens - self.token_safety_margin
+        # Each post also costs a few tokens for its "N. " prefix and newline
+        token_counts = [len(tokens) + 3 for tokens in self.encoding.encode_ordinary_batch(documents)]
+        
+        batches = []
+        current_batch = []
+        current_tokens = 0
+        for text, n_tokens in zip(documents, token_counts):
+            if current_batch and (current_tokens + n_tokens > token_budget
+                                  or len(current_batch) >= self.batch_size):
+                batches.append(current_batch)
+                current_batch = []
+                current_tokens = 0
+            current_batch.append(text)
+            current_tokens += n_tokens
+        
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+    
+    async def classify_sentiment_batch(self, texts: List[str]) -> List[str]:
         """Perform batch sentiment classification using GPT"""
         try:
             formatted_texts = "\n".join([f"{i+1}. {text}" for i, text in enumerate(texts)])
             len_text = len(texts)
 
-            # Use configurable prompt
-            system_prompt = Config.get_sentiment_prompt()
-
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": (
-                            f"Classify the sentiment of these social media posts (Positive, Negative, or Neutral):\n{formatted_texts}\n\n"
-                            f"Return ONLY the JSON object without any extra text, and make sure the number of labels corresponds exactly to {len_text}!!!"
-                        )
-                    }
-                ],
-                response_format={"type": "json_object"}
-            )
+            # Retry with exponential backoff when rate limited
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await self.aclient.chat.completions.create(
+                        model=self.deployment_name,
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": self._system_prompt
+                            },
+                            {
+                                "role": "user",
+                                "content": (
+                                    f"{self._user_prefix}{formatted_texts}\n\n"
+                                    f"Return ONLY the JSON object without any extra text, and make sure the number of labels corresponds exactly to {len_text}!!!"
+                                )
+                            }
+                        ],
+                        response_format={"type": "json_object"}
+                    )
+                    break
+                except RateLimitError:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.api_delay * 2 ** attempt
+                    print(f"⚠️ Rate limited, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+                    await asyncio.sleep(delay)
 
             result = response.choices[0].message.content.strip()
             
             if not result:
                 raise ValueError("Empty response from API")
 
-            sentiments = json.loads(result).get("sentiments", [])
+            sentiments = [str(label).strip().capitalize() for label in json_loads(result).get("sentiments", [])]
+            
+            # Only cache complete responses, never padded or truncated labels, and only known labels
+            if len(sentiments) == len_text and self.cache is not None:
+                valid = [(text, label) for text, label in zip(texts, sentiments) if label in self.VALID_SENTIMENTS]
+                self.cache.put_many([text for text, _ in valid], [label for _, label in valid])
             
             # Ensure count matching
             if len(sentiments) != len_text:
@@ -88,88 +194,138 @@ class SentimentAnalyzer:
             print(f"Error processing batch: {e}")
             return ["Neutral"] * len(texts)
     
-    def analyze_file(self, input_file: str, output_file: str):
-        """Analyze sentiment of a single file"""
-        print(f"=== Starting to process file: {input_file} ===")
+    async def _classify_batches(self, batches: List[List[str]]) -> List[object]:
+        """Classify all batches concurrently, bounded by MAX_CONCURRENT_REQUESTS"""
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        total_batches = len(batches)
         
-        # Extract text content
-        documents = self.extract_text_from_excel(input_file)
+        async def run_batch(batch_num: int, batch: List[str]) -> List[str]:
+            async with semaphore:
+                print(f"Processing batch {batch_num}/{total_batches}, size: {len(batch)}")
+                return await self.classify_sentiment_batch(batch)
         
-        if not documents:
-            print("No valid text data found")
-            return
+        self.aclient = self._create_client()
+        try:
+            # gather preserves input order, so results line up with batches
+            return await asyncio.gather(
+                *(run_batch(i + 1, batch) for i, batch in enumerate(batches)),
+                return_exceptions=True
+            )
+        finally:
+            await self.aclient.close()
+            self.aclient = None
+    
+    def analyze_texts(self, documents: List[str]) -> List[str]:
+        """Classify a list of texts, returning one sentiment per text in order"""
+        # Reuse cached sentiments, only sending cache misses to the API
+        total_docs = len(documents)
+        cached = self.cache.get_many(documents) if self.cache is not None else [None] * total_docs
+        miss_texts = [text for text, sentiment in zip(documents, cached) if sentiment is None]
+        print(f"Cache hits: {total_docs - len(miss_texts)}, entries to classify: {len(miss_texts)}")
         
         # Batch processing
-        results = []
-        total_docs = len(documents)
+        texts_out = []
+        miss_sentiments = []
+        batches = self.pack_batches(miss_texts) if miss_texts else []
+        print(f"Packed {len(miss_texts)} entries into {len(batches)} batches")
+        batch_results = asyncio.run(self._classify_batches(batches)) if batches else []
         
-        for i in range(0, total_docs, self.batch_size):
-            batch = documents[i:i + self.batch_size]
-            batch_num = i // self.batch_size + 1
-            total_batches = (total_docs + self.batch_size - 1) // self.batch_size
-            
-            print(f"Processing batch {batch_num}/{total_batches}, size: {len(batch)}")
+        for batch, sentiments in zip(batches, batch_results):
+            texts_out.extend(batch)
             
-            try:
-                sentiments = self.classify_sentiment_batch(batch)
-                
-                # Strict one-to-one correspondence
-                for j, (text, sentiment) in enumerate(zip(batch, sentiments)):
-                    results.append({
-                        "text": text,
-                        "sentiment": sentiment
-                    })
-                
-                # Fill missing data if count mismatch
-                if len(sentiments) < len(batch):
-                    for j in range(len(sentiments), len(batch)):
-                        results.append({
-                            "text": batch[j],
-                            "sentiment": "Neutral"
-                        })
-                        
-            except Exception as e:
-                print(f"❌ Batch processing failed: {e}")
+            if isinstance(sentiments, Exception):
+                print(f"❌ Batch processing failed: {sentiments}")
                 # Use default values for entire batch on failure
-                for text in batch:
-                    results.append({
-                        "text": text,
-                        "sentiment": "Neutral"
-                    })
+                miss_sentiments.extend(["Neutral"] * len(batch))
+                continue
+            
+            # Strict one-to-one correspondence
+            miss_sentiments.extend(sentiments[:len(batch)])
             
-            time.sleep(self.api_delay)  # API rate limiting
+            # Fill missing data if count mismatch
+            if len(sentiments) < len(batch):
+                miss_sentiments.extend(["Neutral"] * (len(batch) - len(sentiments)))
         
         # Final validation
-        if len(results) != total_docs:
-            print(f"⚠️ Final check failed: input {total_docs}, output {len(results)}")
-            while len(results) < total_docs:
-                missing_idx = len(results)
-                results.append({
-                    "text": documents[missing_idx] if missing_idx < len(documents) else "Missing",
-                    "sentiment": "Neutral"
-                })
-        
-        # Save results
-        df_results = pd.DataFrame(results)
-        df_results.to_excel(output_file, index=False)
-        print(f"✅ Processing complete, results saved to: {output_file}")
-        print(f"Total processed: {len(results)} entries\n")
+        if len(texts_out) != len(miss_texts):
+            print(f"⚠️ Final check failed: input {len(miss_texts)}, output {len(texts_out)}")
+            missing = miss_texts[len(texts_out):]
+            texts_out.extend(missing)
+            miss_sentiments.extend(["Neutral"] * len(missing))
+        
+        # Merge classified misses back into document order
+        miss_iter = iter(miss_sentiments)
+        sentiments_out = [sentiment if sentiment is not None else next(miss_iter) for sentiment in cached]
+        
+        return sentiments_out
+    
+    def analyze_years(self, years: List[int]) -> None:
+        """Analyze all yearly input files as one combined text vector
+        
+        Raises FileNotFoundError if a year's input file is missing and ValueError
+        if no text could be read, so no step after this one runs on stale results.
+        """
+        print(f"=== Starting to process years: {', '.join(str(year) for year in years)} ===")
+        
+        # Extract text content and timestamps of every year, tagged with its year
+        frames = []
+        for year in years:
+            input_file = Config.get_input_file_path(year)
+            if not os.path.exists(input_file):
+                raise FileNotFoundError(f"Input file does not exist: {input_file}")
+            frames.append(self.extract_posts_from_excel(input_file).assign(year=year))
+        
+        all_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if all_df.empty:
+            raise ValueError("No valid text data found")
+        
+        # Classify all years in one pass so batches pack across year boundaries
+        self._open_cache()
+        try:
+            all_df["sentiment"] = self.analyze_texts(all_df["text"].tolist())
+        finally:
+            self._close_cache()
+        
+        # Label quarters from timestamps; rows without a valid timestamp get no quarter
+        if "UTC_Time" not in all_df.columns:
+            all_df["UTC_Time"] = pd.NaT
+        try:
+            # Parse each value on its own format and normalize offsets to naive UTC
+            utc_time = pd.to_datetime(all_df["UTC_Time"], errors="coerce", utc=True, format="mixed").dt.tz_localize(None)
+            all_df["quarter"] = "Q" + utc_time.dt.quarter.astype("Int64").astype("string")
+            all_df["UTC_Time"] = utc_time
+        except Exception as e:
+            # Never lose classified results over timestamps; keep them unlabelled instead
+            print(f"⚠️ Could not label quarters, keeping original timestamps: {e}")
+            all_df["quarter"] = pd.Series(pd.NA, index=all_df.index, dtype="string")
+        
+        unlabelled_count = int(all_df["quarter"].isna().sum())
+        if unlabelled_count:
+            print(f"⚠️ {unlabelled_count} records have no valid timestamp and will not be assigned a quarter")
+        
+        # Split back by year and save results
+        for year, year_df in all_df.groupby("year", sort=False):
+            output_file = Config.get_output_file_path(year)
+            year_df[["text", "sentiment", "UTC_Time"]].to_excel(output_file, index=False)
+            print(f"✅ Results for {year} saved to: {output_file} ({len(year_df)} entries)")
+        
+        # Single labelled store that Step 3 aggregates directly, without quarterly files
+        combined_path = Config.get_combined_results_path()
+        try:
+            all_df.to_parquet(combined_path, index=False, compression="snappy")
+        except Exception:
+            # Never leave combined results of an earlier run behind for Step 3 to chart
+            if os.path.exists(combined_path):
+                os.remove(combined_path)
+            raise
+        print(f"✅ Combined results saved to: {combined_path}")
+        print(f"Total processed: {len(all_df)} entries\n")
 
 
 def main():
     """Main function for sentiment analysis"""
     analyzer = SentimentAnalyzer()
-    
-    # Process files by year
-    for year in Config.ANALYSIS_YEARS:
-        input_file = Config.get_input_file_path(year)
-        output_file = Config.get_output_file_path(year)
-        
-        if not os.path.exists(input_file):
-            print(f"❌ Input file does not exist: {input_file}")
-            continue
-            
-        analyzer.analyze_file(input_file, output_file)
+    analyzer.analyze_years(Config.ANALYSIS_YEARS)
 
 
 if __name__ == "__main__":